@@ -9,14 +9,14 @@ The API in this module is inspired by torch.optim.
 
 """
 
+import math
 import warnings
 
 import torch
 from torch.optim import Optimizer
-import numpy as np
 
 
-EPS = np.finfo(np.float32).eps
+EPS = torch.finfo(torch.float32).eps
 
 
 def backtracking_step_size(
@@ -29,6 +29,7 @@ def backtracking_step_size(
     max_step_size,
     update_direction,
     norm_update_direction,
+    batched=False,
 ):
     """Backtracking step-size finding routine for FW-like algorithms
 
@@ -52,6 +53,10 @@ def backtracking_step_size(
             Update direction given by the FW variant.
         norm_update_direction: float
             Squared L2 norm of update_direction
+        batched: bool
+            If True, f_grad is called on several candidate iterates at once,
+            stacked along a new first dimension, and must return the
+            objective values and gradients stacked the same way.
     Returns:
         step_size_t: float
             Step-size to be used to compute the next iterate.
@@ -68,10 +73,18 @@ def backtracking_step_size(
     if old_f_t is not None:
         tmp = (certificate ** 2) / (2 * (old_f_t - f_t) * norm_update_direction)
         lipschitz_t = max(min(tmp, lipschitz_t), lipschitz_t * ratio_decrease)
+    # only lipschitz_t changes across line search iterations
+    inv_norm_cert = certificate / norm_update_direction
+    half_cert = 0.5 * certificate
+    if batched:
+        return _batched_backtracking_step_size(
+            x, f_t, f_grad, certificate, lipschitz_t, max_step_size,
+            update_direction, norm_update_direction, inv_norm_cert, half_cert,
+            ratio_increase, max_ls_iter)
     for _ in range(max_ls_iter):
-        step_size_t = certificate / (norm_update_direction * lipschitz_t)
+        step_size_t = inv_norm_cert / lipschitz_t
         if step_size_t < max_step_size:
-            rhs = -0.5 * step_size_t * certificate
+            rhs = -half_cert * step_size_t
         else:
             step_size_t = max_step_size
             rhs = (
@@ -91,22 +104,358 @@ def backtracking_step_size(
     return step_size_t, lipschitz_t, f_next, grad_next
 
 
+def _batched_backtracking_step_size(x, f_t, f_grad, certificate, lipschitz_t,
+                                    max_step_size, update_direction,
+                                    norm_update_direction, inv_norm_cert,
+                                    half_cert, ratio_increase, max_ls_iter):
+    """Evaluates the candidates of backtracking_step_size in batches
+    instead of one at a time, and picks the first one verifying
+    the sufficient decrease condition."""
+    n_candidates = 16
+    # candidates are python floats, as in the sequential search:
+    # in x.dtype, the growing Lipschitz estimates would overflow
+    inv_norm_cert, half_cert = float(inv_norm_cert), float(half_cert)
+    certificate, max_step_size = float(certificate), float(max_step_size)
+    norm_update_direction = float(norm_update_direction)
+    for start in range(0, max_ls_iter, n_candidates):
+        lipschitz = [lipschitz_t * ratio_increase ** k
+                     for k in range(start, min(start + n_candidates, max_ls_iter))]
+        step_sizes, rhs = [], []
+        for lipschitz_k in lipschitz:
+            step_size = inv_norm_cert / lipschitz_k
+            if step_size < max_step_size:
+                rhs.append(-half_cert * step_size)
+            else:
+                step_size = max_step_size
+                rhs.append(-step_size * certificate
+                           + 0.5 * (step_size ** 2) * lipschitz_k * norm_update_direction)
+            step_sizes.append(step_size)
+        step_sizes_t = torch.tensor(step_sizes, dtype=x.dtype, device=x.device)
+        xs = x.unsqueeze(0) + step_sizes_t.view(-1, *[1] * x.dim()) * update_direction
+        f_next, grad_next = f_grad(xs)
+        rhs = torch.tensor(rhs, dtype=f_next.dtype, device=f_next.device)
+        verified = (f_next - f_t <= rhs + EPS).nonzero()
+        if len(verified) > 0:
+            # .. sufficient decrease condition verified ..
+            k = verified[0].item()
+            return step_sizes[k], lipschitz[k], f_next[k], grad_next[k]
+    warnings.warn(
+        "Exhausted line search iterations in minimize_frank_wolfe", RuntimeWarning
+    )
+    return (step_sizes[-1], lipschitz[-1] * ratio_increase,
+            f_next[-1], grad_next[-1])
+
+
+def _identity_prox(x, s=None):
+    return x
+
+
+def _wrap_prox(prox, unbatched=False):
+    """Adapts a prox operator acting on batches to a single parameter,
+    unless it is unbatched already. None stands for the identity."""
+    if prox is None:
+        return _identity_prox
+    if unbatched:
+        return prox
+
+    def _prox(x, s=None):
+        return prox(x.unsqueeze(0), s).squeeze(dim=0)
+    return _prox
+
+
+def _wrap_lmo(lmo, unbatched=False):
+    """Adapts an LMO acting on batches to a single parameter,
+    unless it is unbatched already."""
+    if unbatched:
+        return lmo
+
+    def _lmo(u, x):
+        update_direction, max_step_size = lmo(u.unsqueeze(0), x.unsqueeze(0))
+        return update_direction.squeeze(dim=0), max_step_size
+    return _lmo
+
+
+def _flat_buffer(param_groups, name):
+    """Allocates a buffer to hold all parameters flattened and concatenated.
+    Returns it along with the slice of the buffer for each parameter."""
+    params = [p for group in param_groups for p in group['params']]
+    if any(p.dtype != params[0].dtype or p.device != params[0].device for p in params):
+        raise ValueError(f"batched_{name} requires all parameters to have "
+                         "the same dtype and device.")
+    slices = {}
+    start = 0
+    for p in params:
+        slices[p] = slice(start, start + p.numel())
+        start += p.numel()
+    return torch.empty(start, dtype=params[0].dtype, device=params[0].device), slices
+
+
+def _check_no_flat_buffer(optimizer, name):
+    """The flat buffer is sized for the parameters given at initialization."""
+    if getattr(optimizer, '_flat_slices', None) is not None:
+        raise ValueError(f"batched_{name} doesn't support adding parameter groups.")
+
+
+def _check_batched_oracles(oracles, name):
+    if not all(oracle is not None and oracle == oracles[0] for oracle in oracles):
+        raise ValueError(f"batched_{name} requires the same {name} for all parameters.")
+
+
+_NORMALIZATION_CODES = {'none': 0, 'L2': 1, 'Linf': 2, 'sign': 3}
+
+
+def _flat_view(arg):
+    if isinstance(arg, torch.Tensor) and arg.is_contiguous():
+        flat = arg.view(-1)
+        # views would otherwise be specialized on their size
+        torch._dynamo.maybe_mark_dynamic(flat, 0)
+        return flat
+    return arg
+
+
+def _compile(fn):
+    """Returns fn compiled lazily with torch.compile, for the optimizers'
+    compile_steps option.
+
+    Contiguous tensor arguments are passed as 1-D views, so that the compiled
+    code doesn't specialize on their rank or on dimensions of size 1.
+    Compiled functions take float hyperparameters as operands rather than
+    as alpha= arguments, so that they don't trigger a recompilation
+    for each new value.
+    If the compiler backend fails, e.g. when it has no C compiler to use,
+    fn runs as is from then on."""
+    compiled = None
+
+    def _fn(*args):
+        nonlocal compiled
+        if compiled is None:
+            compiled = (torch.compile(fn, dynamic=True, fullgraph=False)
+                        if hasattr(torch, 'compile') else False)
+        if compiled is False:
+            return fn(*args)
+        try:
+            return compiled(*[_flat_view(arg) for arg in args])
+        except torch._dynamo.exc.BackendCompilerFailed as exc:
+            # raised before running any of fn, so fn can run from scratch
+            warnings.warn(f"Compiling {fn.__name__} failed, running it "
+                          f"without compilation: {exc}", RuntimeWarning)
+            compiled = False
+            return fn(*args)
+    return _fn
+
+
+def _normalize(grad, normalization_code: int):
+    """normalization_code follows _NORMALIZATION_CODES."""
+    if normalization_code == 1:
+        return grad / torch.linalg.vector_norm(grad)
+    if normalization_code == 2:
+        return grad / grad.abs().amax()
+    if normalization_code == 3:
+        return torch.sign(grad)
+    return grad
+
+
 def normalize_gradient(grad, normalization):
-    if normalization == 'none':
-        return grad
-    elif normalization == 'Linf':
-        grad = grad / abs(grad).max()
+    """Normalizes grad, normalization is one of 'none', 'L2', 'Linf', 'sign'."""
+    if normalization not in _NORMALIZATION_CODES:
+        raise ValueError(f"Normalization must be in {set(_NORMALIZATION_CODES)}")
+    return _normalize(grad, _NORMALIZATION_CODES[normalization])
+
+
+def _normalize_into(grad, normalization_code, out):
+    """_normalize writing into out, without temporaries the size of grad."""
+    if normalization_code == 1:
+        return torch.div(grad, torch.linalg.vector_norm(grad), out=out)
+    if normalization_code == 2:
+        return torch.div(grad, torch.linalg.vector_norm(grad, float('inf')), out=out)
+    if normalization_code == 3:
+        return torch.sign(grad, out=out)
+    return grad
 
-    elif normalization == 'sign':
-        grad = torch.sign(grad)
 
-    elif normalization == 'L2':
-        grad = grad / torch.norm(grad)
+def _pgd_update(p, grad_estimate, out, step_size, normalization_code):
+    """Gradient normalization and gradient step, without temporaries.
+    Writes the point to feed to prox into out.
+    normalization_code follows _NORMALIZATION_CODES."""
+    direction = _normalize_into(grad_estimate, normalization_code, out)
+    torch.sub(p, direction, alpha=step_size, out=out)
+
+
+def _fused_pgd_update(p, grad_estimate, out, step_size: float, normalization_code: int):
+    """_pgd_update for compilation, which fuses it into a single kernel."""
+    out.copy_(p - step_size * _normalize(grad_estimate, normalization_code))
+
+
+def _pgd_certificate(p, new_p, step_size: float):
+    return torch.linalg.vector_norm((p - new_p) / step_size)
+
+
+def _foreach_pgd_update(params, grad_estimates, step_sizes, normalization_code):
+    """Gradient step for parameters without prox, batched across parameters
+    with foreach kernels. Updates params in place and returns the certificates."""
+    if normalization_code == 1:
+        directions = torch._foreach_div(grad_estimates,
+                                        torch._foreach_norm(grad_estimates))
+    elif normalization_code == 2:
+        directions = torch._foreach_div(grad_estimates,
+                                        torch._foreach_norm(grad_estimates, float('inf')))
+    elif normalization_code == 3:
+        directions = torch._foreach_sign(grad_estimates)
+    else:
+        directions = grad_estimates
+    # without prox, (p - new_p) / step_size is the direction itself
+    certificates = torch._foreach_norm(directions)
+    _foreach_add_scaled_(params, directions, step_sizes, alpha=-1.)
+    return certificates
+
+
+def _foreach_add_scaled_(params, directions, step_sizes, alpha=1.):
+    """params[i] += alpha * step_sizes[i] * directions[i], in place."""
+    if len(set(step_sizes)) == 1:
+        torch._foreach_add_(params, directions, alpha=alpha * step_sizes[0])
+    else:
+        torch._foreach_add_(params, torch._foreach_mul(directions, step_sizes),
+                            alpha=alpha)
+
+
+def _fw_certificate(grad_estimate, update_direction):
+    return (-grad_estimate * update_direction).sum()
+
+
+def _fw_stats(grad_estimate, update_direction):
+    """FW gap and norms of update_direction and grad_estimate.
+    Compiled as part of _fw_normalized_update, the three reductions
+    are fused into a single pass over each tensor. Run eagerly,
+    they are separate reductions after a product temporary."""
+    return ((-grad_estimate * update_direction).sum(),
+            torch.linalg.vector_norm(update_direction),
+            torch.linalg.vector_norm(grad_estimate))
+
+
+def _fw_normalized_update(p, grad_estimate, update_direction, step_size: float):
+    """Certificate computation and update of p with gradient
+    normalization, in place, fused when compiled. Returns the FW gap."""
+    certificate, update_norm, grad_norm = _fw_stats(grad_estimate, update_direction)
+    step = step_size * grad_norm / update_norm
+    step = torch.where(step < 1., step, torch.ones_like(step))
+    p.add_(step * update_direction)
+    return certificate
+
+
+def _s3cm_dual_step(iterate_1, iterate_2, dual, grad, out, lr):
+    """Dual update, in place and without temporaries.
+    Writes the point to feed to prox1 into out."""
+    torch.sub(iterate_1, iterate_2, out=out)
+    dual.add_(out, alpha=1. / lr)
+    torch.add(grad, dual, out=out)
+    torch.sub(iterate_2, out, alpha=lr, out=out)
 
-    return grad
-        
 
-class PGD(Optimizer):
+def _fused_s3cm_dual_step(iterate_1, iterate_2, dual, grad, out, lr: float):
+    """_s3cm_dual_step for compilation, which fuses it into a single kernel."""
+    dual.add_((iterate_1 - iterate_2) / lr)
+    out.copy_(iterate_2 - lr * (grad + dual))
+
+
+_compiled_pgd_update = _compile(_fused_pgd_update)
+_compiled_pgd_certificate = _compile(_pgd_certificate)
+_compiled_fw_certificate = _compile(_fw_certificate)
+_compiled_fw_normalized_update = _compile(_fw_normalized_update)
+_compiled_s3cm_dual_step = _compile(_fused_s3cm_dual_step)
+
+
+class _LRMixin:
+    """lr of an optimizer, float or 'sublinear'.
+    Resolved once when set, so that steps don't have to inspect it."""
+
+    @property
+    def lr(self):
+        return self._lr
+
+    @lr.setter
+    def lr(self, lr):
+        if not (isinstance(lr, float) or lr == 'sublinear'):
+            raise ValueError("lr must be float or 'sublinear'.")
+        self._lr = lr
+        self._lr_is_sublinear = lr == 'sublinear'
+        self._lr_val = 0. if self._lr_is_sublinear else lr
+
+
+class _GraphCaptureMixin(_LRMixin):
+    """Lets an optimizer record its step in a CUDA graph and replay it,
+    launching all of the step's kernels at once.
+    Subclasses implement _step, the step without closure, and extend
+    _check_capturable.
+    Setting lr drops the captured step, which would keep using the old one."""
+    _graph = None
+
+    @_LRMixin.lr.setter
+    def lr(self, lr):
+        _LRMixin.lr.fset(self, lr)
+        self._graph = None
+
+    def load_state_dict(self, state_dict):
+        # the captured step reads and writes the replaced state tensors
+        self._graph = None
+        super().load_state_dict(state_dict)
+
+    def capture(self):
+        """Captures the optimization step in a CUDA graph.
+        Later calls to step replay the graph instead of running the step
+        from python.
+
+        Runs a regular optimization step first, as warmup.
+        Parameters and their gradients have to be CUDA tensors.
+        Hyperparameters such as lr and momentum are baked into the graph:
+        setting lr or loading a state dict drops the graph, and capture
+        has to be called again after changing the others.
+        Gradients have to stay in the same memory across steps,
+        e.g. by calling zero_grad(set_to_none=False).
+        Oracles have to be capturable, i.e. be pure tensor operations
+        without host synchronization, and state['step'] is not updated
+        by replays.
+        """
+        self._check_capturable()
+        self._graph = None
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            self._step()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            self._step()
+        self._graph = graph
+        self._graph_grads = self._grad_pointers()
+
+    def _check_capturable(self):
+        for group in self.param_groups:
+            for p in group['params']:
+                if not (p.is_cuda and p.grad is not None and p.grad.is_cuda):
+                    raise RuntimeError("capture requires CUDA parameters "
+                                       "and gradients.")
+
+    def _grad_pointers(self):
+        return [None if p.grad is None else p.grad.data_ptr()
+                for group in self.param_groups for p in group['params']]
+
+    def _replay(self):
+        """Replays the captured step if there is one and gradients
+        are where it expects them. Returns whether it did."""
+        if self._graph is None:
+            return False
+        if self._grad_pointers() != self._graph_grads:
+            warnings.warn("Gradients moved since capture, dropping the CUDA "
+                          "graph and running the step without it.", RuntimeWarning)
+            # the eager step replaces the state tensors the graph writes to
+            self._graph = None
+            return False
+        self._graph.replay()
+        return True
+
+
+class PGD(_GraphCaptureMixin, Optimizer):
     """Proximal Gradient Descent
 
     Args:
@@ -122,26 +471,34 @@ class PGD(Optimizer):
         Type of gradient normalization to be used.
         Possible values are 'none', 'L2', 'Linf', 'sign'.
 
+      batched_prox: bool
+        If True, all parameters are flattened and concatenated, and prox is
+        applied once to the resulting vector, which it constrains jointly.
+        Requires the same prox for all parameters.
+
+      compile_steps: bool
+        If True, the elementwise updates of each parameter are compiled
+        with torch.compile into fused kernels.
+        Off by default: for small parameters, the guard checks of compiled
+        code cost more than the kernels they save.
+
     """
     name = 'PGD'
     POSSIBLE_NORMALIZATIONS = {'none', 'L2', 'Linf', 'sign'}
 
-    def __init__(self, params, prox=None, lr=.1, momentum=.9, normalization='none'):
+    def __init__(self, params, prox=None, lr=.1, momentum=.9, normalization='none',
+                 batched_prox=False, compile_steps=False):
         if prox is None:
             prox = [None] * len(params)
+        if batched_prox:
+            _check_batched_oracles(prox, 'prox')
 
-        self.prox = []
-        for prox_el in prox:
-            if prox_el is not None:
-                self.prox.append(lambda x, s=None: prox_el(x.unsqueeze(0)).squeeze())
-            else:
-                self.prox.append(lambda x, s=None: x)
+        self.prox = [_wrap_prox(prox_el) for prox_el in prox]
+        self._prox_is_identity = [prox_el is None for prox_el in prox]
 
-        if not (type(lr) == float or lr == 'sublinear'):
-            raise ValueError("lr must be float or 'sublinear'.")
         self.lr = lr
 
-        if type(momentum) == float:
+        if isinstance(momentum, float):
             if not(0. <= momentum <= 1.):
                 raise ValueError("Momentum must be in [0., 1.].")
         self.momentum = momentum
@@ -150,28 +507,66 @@ class PGD(Optimizer):
             self.normalization = normalization
         else:
             raise ValueError(f"Normalization must be in {self.POSSIBLE_NORMALIZATIONS}")
-        defaults = dict(prox=self.prox, name=self.name, normalization=self.normalization)
+        self._normalization_code = _NORMALIZATION_CODES[normalization]
+
+        self.compile_steps = compile_steps
+        if compile_steps:
+            self._pgd_update = _compiled_pgd_update
+            self._pgd_certificate = _compiled_pgd_certificate
+        else:
+            self._pgd_update = _pgd_update
+            self._pgd_certificate = _pgd_certificate
+
+        defaults = dict(lr=self.lr)
         super(PGD, self).__init__(params, defaults)
 
+        self.batched_prox = batched_prox
+        if batched_prox:
+            self._flat, self._flat_slices = _flat_buffer(self.param_groups, 'prox')
+
+    def add_param_group(self, param_group):
+        _check_no_flat_buffer(self, 'prox')
+        super().add_param_group(param_group)
+
     @property
     @torch.no_grad()
     def certificate(self):
         """A generator over the current convergence certificate estimate
-        for each optimized parameter."""
+        for each optimized parameter.
+        Certificates are 0-d tensors kept on the parameter's device;
+        reading them (e.g. with .item()) forces a device synchronization,
+        so only do so when the value is needed."""
         for groups in self.param_groups:
             for p in groups['params']:
                 state = self.state[p]
                 yield state['certificate']
 
+    def _check_capturable(self):
+        if self._lr_is_sublinear:
+            raise ValueError("capture requires a constant lr.")
+        super()._check_capturable()
+
     @torch.no_grad()
     def step(self, closure=None):
         loss = None
         if closure is not None:
             with torch.enable_grad():
                 loss = closure()
-        idx = 0
+        if not self._replay():
+            self._step()
+        return loss
+
+    @torch.no_grad()
+    def _step(self):
+        grads, grad_estimates = [], []
+        # parameters without prox are updated together with foreach ops
+        foreach_params, foreach_grad_estimates, foreach_step_sizes = [], [], []
+        prox_updates = []
+        # idx is the position of the parameter, oracles are looked up by it
+        idx = -1
         for groups in self.param_groups:
             for p in groups['params']:
+                idx += 1
                 if p.grad is None:
                     continue
 
@@ -185,27 +580,76 @@ class PGD(Optimizer):
                 # Initialization
                 if len(state) == 0:
                     state['step'] = 0.
-                    state['grad_estimate'] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format)
+                    state['grad_estimate'] = None
+                    if not (self._prox_is_identity[idx] or self.batched_prox):
+                        state['scratch'] = torch.empty_like(
+                            p, memory_format=torch.preserve_format)
 
                 state['step'] += 1.
-                state['grad_estimate'].add_(grad - state['grad_estimate'], alpha=1. - self.momentum)
 
-                grad_est = normalize_gradient(state['grad_estimate'], self.normalization)
-
-                if self.lr == 'sublinear':
+                if self._lr_is_sublinear:
                     step_size = 1. / (state['step'] + 1.)
                 else:
-                    step_size = self.lr
+                    step_size = self._lr_val
+
+                if state['grad_estimate'] is None:
+                    # the first estimate is (1 - momentum) * grad,
+                    # no need to start from zeros
+                    state['grad_estimate'] = grad.mul(1. - self.momentum)
+                else:
+                    grads.append(grad)
+                    grad_estimates.append(state['grad_estimate'])
+                if self._prox_is_identity[idx]:
+                    foreach_params.append(p)
+                    foreach_grad_estimates.append(state['grad_estimate'])
+                    foreach_step_sizes.append(step_size)
+                else:
+                    prox_updates.append((idx, p, step_size))
+
+        if grad_estimates:
+            torch._foreach_lerp_(grad_estimates, grads, 1. - self.momentum)
 
-                new_p = self.prox[idx](p - step_size * grad_est, 1.)
-                state['certificate'] = torch.norm((p - new_p) / step_size)
+        if self.batched_prox:
+            self._batched_prox_update(prox_updates)
+        else:
+            for idx, p, step_size in prox_updates:
+                state = self.state[p]
+                self._pgd_update(p, state['grad_estimate'], state['scratch'], step_size,
+                            self._normalization_code)
+                # prox is a python callable, so it stays outside the compiled code
+                new_p = self.prox[idx](state['scratch'], 1.)
+                # stays on device, see the certificate property
+                state['certificate'] = self._pgd_certificate(p, new_p, step_size)
                 p.copy_(new_p)
-                idx += 1
-        return loss
 
+        if foreach_params:
+            certificates = _foreach_pgd_update(foreach_params, foreach_grad_estimates,
+                                               foreach_step_sizes,
+                                               self._normalization_code)
+            for p, certificate in zip(foreach_params, certificates):
+                self.state[p]['certificate'] = certificate
+
+    def _batched_prox_update(self, prox_updates):
+        """Gradient step for all parameters followed by a single prox call
+        on all of them, flattened and concatenated in self._flat."""
+        for _, p, step_size in prox_updates:
+            self._pgd_update(p, self.state[p]['grad_estimate'],
+                        self._flat[self._flat_slices[p]].view_as(p), step_size,
+                        self._normalization_code)
+        if len(prox_updates) < len(self._flat_slices):
+            # parameters without gradient keep their current value
+            for p, flat_slice in self._flat_slices.items():
+                if p.grad is None:
+                    self._flat[flat_slice].view_as(p).copy_(p)
+
+        new_flat = self.prox[0](self._flat, 1.)
+        for _, p, step_size in prox_updates:
+            new_p = new_flat[self._flat_slices[p]].view_as(p)
+            self.state[p]['certificate'] = self._pgd_certificate(p, new_p, step_size)
+            p.copy_(new_p)
 
-class PGDMadry(Optimizer):
+
+class PGDMadry(_LRMixin, Optimizer):
     """PGD from [1]. 
 
     Args:
@@ -221,6 +665,11 @@ class PGDMadry(Optimizer):
       lr: float > 0
         learning rate
 
+      unbatched: bool
+        If True, lmo and prox act on a single parameter and are used as is.
+        Otherwise they act on batches, as the ones in chop.constraints,
+        and are called on each parameter as a batch of size 1.
+
     References:
       Madry, Aleksander, and Makelov, Aleksandar, and Schmidt, Ludwig,
       and Tsipras, Dimitris, and Vladu, Adrian. Towards Deep Learning Models
@@ -228,36 +677,25 @@ class PGDMadry(Optimizer):
     """
     name = 'PGD-Madry'
 
-    def __init__(self, params, lmo, prox=None, lr=1e-2):
-        self.prox = []
-        for prox_el in prox:
-            if prox_el is None:
-                def prox_el(x, s=None):
-                    return x
-
-            def _prox(x, s=None):
-                return prox_el(x.unsqueeze(0), s).squeeze()
-            self.prox.append(_prox)
-
-        self.lmo = []
-        for lmo_el in lmo:
-            def _lmo(u, x):
-                update_direction, max_step_size = lmo_el(u.unsqueeze(0), x.unsqueeze(0))
-                return update_direction.squeeze(dim=0), max_step_size
-            self.lmo.append(_lmo)
-
-        if not (type(lr) == float or lr == 'sublinear'):
-            raise ValueError("lr must be float or 'sublinear'.")
+    def __init__(self, params, lmo, prox=None, lr=1e-2, unbatched=False):
+        if prox is None:
+            prox = [None] * len(lmo)
+        self.prox = [_wrap_prox(prox_el, unbatched) for prox_el in prox]
+        self._prox_is_identity = [prox_el is None for prox_el in prox]
+        self.lmo = [_wrap_lmo(lmo_el, unbatched) for lmo_el in lmo]
 
         self.lr = lr
-        defaults = dict(prox=self.prox, lmo=self.lmo, name=self.name)
+        defaults = dict(lr=self.lr)
         super(PGDMadry, self).__init__(params, defaults)
 
     @property
     @torch.no_grad()
     def certificate(self):
         """A generator over the current convergence certificate estimate
-        for each optimized parameter."""
+        for each optimized parameter.
+        Certificates are 0-d tensors kept on the parameter's device;
+        reading them (e.g. with .item()) forces a device synchronization,
+        so only do so when the value is needed."""
         for groups in self.param_groups:
             for p in groups['params']:
                 state = self.state[p]
@@ -269,9 +707,10 @@ class PGDMadry(Optimizer):
         if closure is not None:
             with torch.enable_grad():
                 loss = closure()
-        idx = 0
+        idx = -1
         for groups in self.param_groups:
             for p in groups['params']:
+                idx += 1
                 if p.grad is None:
                     continue
                 grad = p.grad
@@ -284,16 +723,20 @@ class PGDMadry(Optimizer):
                     state['step'] = 0.
                 state['step'] += 1.
 
-                if self.lr == 'sublinear':
+                if self._lr_is_sublinear:
                     step_size = 1. / (state['step'] + 1.)
                 else:
-                    step_size = self.lr
+                    step_size = self._lr_val
                 lmo_res, _ = self.lmo[idx](-p.grad, p)
                 normalized_grad = lmo_res + p
-                new_p = self.prox[idx](p + step_size * normalized_grad)
-                state['certificate'] = torch.norm((p - new_p) / step_size)
-                p.copy_(new_p)
-                idx += 1
+                if self._prox_is_identity[idx]:
+                    p.add_(normalized_grad, alpha=step_size)
+                    # without prox, (p - new_p) / step_size is -normalized_grad
+                    state['certificate'] = torch.linalg.vector_norm(normalized_grad)
+                else:
+                    new_p = self.prox[idx](p + step_size * normalized_grad)
+                    state['certificate'] = torch.linalg.vector_norm((p - new_p) / step_size)
+                    p.copy_(new_p)
         return loss
 
 
@@ -318,6 +761,12 @@ class S3CM(Optimizer):
         Normalizes the gradient. 'L2', 'Linf' divide the gradient by the corresponding norm.
         'sign' uses the sign of the gradient.
 
+      compile_steps: bool
+        If True, the dual update of each parameter is compiled
+        with torch.compile into a fused kernel.
+        Off by default: for small parameters, the guard checks of compiled
+        code cost more than the kernels they save.
+
     References:
       Yurtsever, Alp, and Vu, Bang Cong, and Cevher, Volkan.
       "Stochastic Three-Composite Convex Minimization" NeurIPS 2016
@@ -325,8 +774,9 @@ class S3CM(Optimizer):
     name = "S3CM"
     POSSIBLE_NORMALIZATIONS = {'none', 'L2', 'Linf', 'sign'}
 
-    def __init__(self, params, prox1=None, prox2=None, lr=.1, normalization='none'):
-        if not type(lr) == float:
+    def __init__(self, params, prox1=None, prox2=None, lr=.1, normalization='none',
+                 compile_steps=False):
+        if not isinstance(lr, float):
             raise ValueError("lr must be a float.")
 
         self.lr = lr
@@ -334,27 +784,21 @@ class S3CM(Optimizer):
             self.normalization = normalization
         else:
             raise ValueError(f"Normalization must be in {self.POSSIBLE_NORMALIZATIONS}")
+        self._normalization_code = _NORMALIZATION_CODES[normalization]
 
         if prox1 is None:
             prox1 = [None] * len(params)
         if prox2 is None:
             prox2 = [None] * len(params)
 
-        self.prox1 = []
-        self.prox2 = []
+        self.prox1 = [_wrap_prox(prox1_) for prox1_ in prox1]
+        self.prox2 = [_wrap_prox(prox2_) for prox2_ in prox2]
 
-        for prox1_, prox2_ in zip(prox1, prox2):
-            if prox1_ is None:
-                def prox1_(x, s=None): return x
+        self.compile_steps = compile_steps
+        self._s3cm_dual_step = (_compiled_s3cm_dual_step if compile_steps
+                                else _s3cm_dual_step)
 
-            if prox2_ is None:
-                def prox2_(x, s=None): return x
-
-            self.prox1.append(lambda x, s=None: prox1_(x.unsqueeze(0), s).squeeze(dim=0))
-            self.prox2.append(lambda x, s=None: prox2_(x.unsqueeze(0), s).squeeze(dim=0))
-
-        defaults = dict(lr=self.lr, prox1=self.prox1, prox2=self.prox2,
-                        normalization=self.normalization)
+        defaults = dict(lr=self.lr)
         super(S3CM, self).__init__(params, defaults)
 
 
@@ -364,14 +808,15 @@ class S3CM(Optimizer):
         if closure is not None:
             with torch.enable_grad():
                 loss = closure()
-        idx = 0
+        idx = -1
         for group in self.param_groups:
             for p in group['params']:
+                idx += 1
                 if p.grad is None:
                     continue
                 grad = p.grad
 
-                grad = normalize_gradient(grad, self.normalization)
+                grad = _normalize(grad, self._normalization_code)
 
                 if grad.is_sparse:
                     raise RuntimeError(
@@ -381,16 +826,22 @@ class S3CM(Optimizer):
                 if len(state) == 0:
                     state['step'] = 0
                     state['iterate_1'] = p.clone().detach()
-                    state['iterate_2'] = self.prox2[idx](p, self.lr)
+                    # iterate_2 is updated in place, so it can't alias p
+                    state['iterate_2'] = self.prox2[idx](p, self.lr).clone()
                     state['dual'] = (state['iterate_1'] - state['iterate_2']) / self.lr
+                    state['scratch1'] = torch.empty_like(
+                        p, memory_format=torch.preserve_format)
+                    state['scratch2'] = torch.empty_like(
+                        p, memory_format=torch.preserve_format)
 
-                state['iterate_2'] = self.prox2[idx](state['iterate_1'] + self.lr * state['dual'], self.lr)
-                state['dual'].add_((state['iterate_1'] - state['iterate_2']) / self.lr)
-                state['iterate_1'] = self.prox1[idx](state['iterate_2'] 
-                                                     - self.lr * (grad + state['dual']), self.lr)
+                torch.add(state['iterate_1'], state['dual'], alpha=self.lr,
+                          out=state['scratch1'])
+                state['iterate_2'].copy_(self.prox2[idx](state['scratch1'], self.lr))
+                self._s3cm_dual_step(state['iterate_1'], state['iterate_2'], state['dual'],
+                                grad, state['scratch2'], self.lr)
+                state['iterate_1'] = self.prox1[idx](state['scratch2'], self.lr)
 
                 p.copy_(state['iterate_2'])
-                idx += 1
 
 
 class PairwiseFrankWolfe(Optimizer):
@@ -398,22 +849,19 @@ class PairwiseFrankWolfe(Optimizer):
     name = "Pairwise-FW"
 
     def __init__(self, params, lmo_pairwise, lr=.1, momentum=.9):
-        if not (type(lr) == float or lr == 'sublinear'):
+        if not (isinstance(lr, float) or lr == 'sublinear'):
             raise ValueError("lr must be float or 'sublinear'.")
 
-        def _lmo(u, x):
-            update_direction, max_step_size = lmo_pairwise(u.unsqueeze(0), x.unsqueeze(0))
-            return update_direction.squeeze(dim=0), max_step_size
-        self.lmo = _lmo
+        self.lmo = _wrap_lmo(lmo_pairwise)
         self.lr = lr
         self.momentum = momentum
-        defaults = dict(lmo=self.lmo, name=self.name, lr=self.lr, momentum=self.momentum)
+        defaults = dict(lr=self.lr)
         super(PairwiseFrankWolfe, self).__init__(params, defaults)
 
         raise NotImplementedError
 
 
-class FrankWolfe(Optimizer):
+class FrankWolfe(_GraphCaptureMixin, Optimizer):
     """Class for the Stochastic Frank-Wolfe algorithm given in Mokhtari et al.
     This is essentially Frank-Wolfe with Momentum.
     We use the tricks from [1] for gradient normalization.
@@ -437,6 +885,23 @@ class FrankWolfe(Optimizer):
       normalization: str in {'gradient', 'none'}
         Gradient normalization to be used. 'gradient' option is described in [1].
 
+      batched_lmo: bool
+        If True, all parameters are flattened and concatenated, and the LMO is
+        called once on the resulting vector, which it constrains jointly.
+        Requires the same lmo for all parameters.
+
+      unbatched: bool
+        If True, lmo acts on a single parameter and is used as is.
+        Otherwise it acts on batches, as the ones in chop.constraints,
+        and is called on each parameter as a batch of size 1.
+
+      compile_steps: bool
+        If True, the certificate computation and the gradient normalized
+        update of each parameter are compiled with torch.compile
+        into fused kernels.
+        Off by default: for small parameters, the guard checks of compiled
+        code cost more than the kernels they save.
+
     References:
       Pokutta, Sebastian, and Spiegel, Christoph and Zimmer, Max,
       Deep Neural Network Training with Frank Wolfe. 2020.
@@ -446,40 +911,60 @@ class FrankWolfe(Optimizer):
 
     def __init__(self, params, lmo, lr=.1, momentum=.9, 
                  weight_decay=0.,
-                 normalization='none'):
+                 normalization='none',
+                 batched_lmo=False,
+                 unbatched=False,
+                 compile_steps=False):
 
-        self.lmo = []
-        for oracle in lmo:
-            def _lmo(u, x):
-                update_direction, max_step_size = oracle(u.unsqueeze(0), x.unsqueeze(0))
-                return update_direction.squeeze(dim=0), max_step_size
-            self.lmo.append(_lmo)
+        if batched_lmo:
+            _check_batched_oracles(lmo, 'lmo')
+        self.lmo = [_wrap_lmo(oracle, unbatched) for oracle in lmo]
 
-        if type(lr) == float:
+        if isinstance(lr, float):
             if not (0. < lr <= 1.):
                 raise ValueError("lr must be in (0., 1.].")
         self.lr = lr
-        if type(momentum) == float:
+        if isinstance(momentum, float):
             if not(0. <= momentum <= 1.):
                 raise ValueError("Momentum must be in [0., 1.].")
         self.momentum = momentum
+        self._momentum_is_adaptive = momentum is None
+        self._rho_cache = []
         if not (weight_decay >= 0):
             raise ValueError("weight_decay should be nonnegative.")
-        self.weight_decay = weight_decay
+        self.weight_decay = float(weight_decay)
         if normalization not in self.POSSIBLE_NORMALIZATIONS:
             raise ValueError(f"Normalization must be in {self.POSSIBLE_NORMALIZATIONS}.")
         self.normalization = normalization
-        defaults = dict(lmo=self.lmo, name=self.name, lr=self.lr, 
-                        momentum=self.momentum,
-                        weight_decay=weight_decay,
-                        normalization=self.normalization)
+
+        self.compile_steps = compile_steps
+        if compile_steps:
+            self._fw_certificate = _compiled_fw_certificate
+            self._fw_normalized_update = _compiled_fw_normalized_update
+        else:
+            self._fw_certificate = _fw_certificate
+            self._fw_normalized_update = _fw_normalized_update
+
+        defaults = dict(lr=self.lr)
         super(FrankWolfe, self).__init__(params, defaults)
 
+        self.batched_lmo = batched_lmo
+        if batched_lmo:
+            self._flat_grad, self._flat_slices = _flat_buffer(self.param_groups, 'lmo')
+            self._flat_iterate = torch.empty_like(self._flat_grad)
+
+    def add_param_group(self, param_group):
+        _check_no_flat_buffer(self, 'lmo')
+        super().add_param_group(param_group)
+
     @property
     @torch.no_grad()
     def certificate(self):
         """A generator over the current convergence certificate estimate
-        for each optimized parameter."""
+        for each optimized parameter.
+        Certificates are 0-d tensors kept on the parameter's device;
+        reading them (e.g. with .item()) forces a device synchronization,
+        so only do so when the value is needed."""
         for group in self.param_groups:
             for p in group['params']:
                 state = self.state[p]
@@ -496,44 +981,117 @@ class FrankWolfe(Optimizer):
         if closure is not None:
             with torch.enable_grad():
                 loss = closure()
-        idx = 0
+        if not self._replay():
+            self._step()
+        return loss
+
+    def _check_capturable(self):
+        if self._lr_is_sublinear or self._momentum_is_adaptive:
+            raise ValueError("capture requires a constant lr and momentum.")
+        super()._check_capturable()
+
+    def _rho_at(self, step):
+        """Adaptive momentum schedule, 1 - momentum at the given step.
+        Grown lazily and cached."""
+        step = int(step)
+        while len(self._rho_cache) <= step:
+            self._rho_cache.append(math.pow(1. / (len(self._rho_cache) + 1), 1 / 3))
+        return self._rho_cache[step]
+
+    @torch.no_grad()
+    def _step(self):
+        params, grads, grad_estimates, step_sizes, weights = [], [], [], [], []
+        # positions of the parameters, oracles are looked up by them
+        indices = []
+        idx = -1
         for group in self.param_groups:
             for p in group['params']:
+                idx += 1
                 if p.grad is None:
                     continue
-                grad = p.grad + self.weight_decay * p
+                grad = p.grad
                 if grad.is_sparse:
                     raise RuntimeError(
                         'SFW does not yet support sparse gradients.')
                 state = self.state[p]
                 if len(state) == 0:
                     state['step'] = 0
-                    state['grad_estimate'] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format)
+                    state['grad_estimate'] = None
 
-                if self.lr == 'sublinear':
+                if self._lr_is_sublinear:
                     step_size = 1. / (state['step'] + 1.)
-                elif type(self.lr) == float:
-                    step_size = self.lr
                 else:
-                    raise ValueError("lr must be float or 'sublinear'.")
+                    step_size = self._lr_val
 
-                if self.momentum is None:
-                    rho = (1. / (state['step'] + 1)) ** (1/3)
-                    momentum = 1. - rho
+                if self._momentum_is_adaptive:
+                    momentum = 1. - self._rho_at(state['step'])
                 else:
                     momentum = self.momentum
 
                 state['step'] += 1.
 
-                state['grad_estimate'].add_(grad - state['grad_estimate'], alpha=1. - momentum)
-                update_direction, _ = self.lmo[idx](-state['grad_estimate'], p)
-                state['certificate'] = (-state['grad_estimate'] * update_direction).sum()
-                if self.normalization == 'gradient':
-                    grad_norm = torch.norm(state['grad_estimate'])
-                    step_size = min(1., step_size * grad_norm / torch.linalg.norm(update_direction))
-                elif self.normalization == 'none':
-                    pass
-                p.add_(step_size * update_direction)
-                idx += 1
-        return loss
+                indices.append(idx)
+                params.append(p)
+                grads.append(grad)
+                step_sizes.append(step_size)
+                weights.append(1. - momentum)
+
+        if not params:
+            return
+        if self.weight_decay:
+            grads = torch._foreach_add(grads, params, alpha=self.weight_decay)
+        lerp_grads, lerp_estimates, lerp_weights = [], [], []
+        for p, grad, weight in zip(params, grads, weights):
+            state = self.state[p]
+            if state['grad_estimate'] is None:
+                # the first estimate is (1 - momentum) * grad,
+                # no need to start from zeros
+                state['grad_estimate'] = grad.mul(weight)
+            else:
+                lerp_grads.append(grad)
+                lerp_estimates.append(state['grad_estimate'])
+                lerp_weights.append(weight)
+        if lerp_estimates:
+            if len(set(lerp_weights)) == 1:
+                lerp_weights = lerp_weights[0]
+            torch._foreach_lerp_(lerp_estimates, lerp_grads, lerp_weights)
+        grad_estimates = [self.state[p]['grad_estimate'] for p in params]
+
+        if self.batched_lmo:
+            update_directions = self._batched_lmo(params, grad_estimates)
+        else:
+            update_directions = [self.lmo[idx](-grad_estimate, p)[0]
+                                 for idx, p, grad_estimate
+                                 in zip(indices, params, grad_estimates)]
+
+        # parameters are updated together with foreach ops
+        # unless the step size depends on the parameter
+        foreach_directions = []
+        for p, grad_estimate, update_direction, step_size in zip(
+                params, grad_estimates, update_directions, step_sizes):
+            state = self.state[p]
+            if self.normalization == 'gradient':
+                state['certificate'] = self._fw_normalized_update(p, grad_estimate,
+                                                                  update_direction,
+                                                                  step_size)
+            else:
+                state['certificate'] = self._fw_certificate(grad_estimate,
+                                                            update_direction)
+                foreach_directions.append(update_direction)
+
+        if foreach_directions:
+            _foreach_add_scaled_(params, foreach_directions, step_sizes)
+
+    def _batched_lmo(self, params, grad_estimates):
+        """Calls the LMO once on all parameters, flattened and concatenated.
+        Returns the update direction for each parameter in params."""
+        if len(params) < len(self._flat_slices):
+            # parameters without gradient get a zero gradient estimate
+            self._flat_grad.zero_()
+        torch._foreach_copy_([self._flat_grad[self._flat_slices[p]].view_as(p)
+                              for p in params], grad_estimates)
+        all_params = list(self._flat_slices)
+        torch._foreach_copy_([self._flat_iterate[self._flat_slices[p]].view_as(p)
+                              for p in all_params], all_params)
+        update_direction, _ = self.lmo[0](self._flat_grad.neg_(), self._flat_iterate)
+        return [update_direction[self._flat_slices[p]].view_as(p) for p in params]
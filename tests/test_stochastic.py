@@ -90,3 +90,410 @@ def test_L1Ball(algorithm, lr):
         store[optimizer.name].flush_row()
 
     store.close()
+
+
+def test_normalize_gradient():
+    grad = torch.tensor([3., -4.])
+    assert torch.allclose(stochastic.normalize_gradient(grad, 'L2'), grad / 5.)
+    assert torch.allclose(stochastic.normalize_gradient(grad, 'Linf'), grad / 4.)
+    with pytest.raises(ValueError):
+        stochastic.normalize_gradient(grad, 'L1')
+
+
+def test_backtracking_step_size_batched():
+    def f_grad(x):
+        # works both on a single iterate and on a batch of iterates
+        residual = x @ X.T - y
+        return .5 * (residual ** 2).sum(-1), residual @ X
+
+    x = torch.zeros(n_features)
+    f_t, grad = f_grad(x)
+    update_direction = -grad
+    certificate = (grad ** 2).sum().item()
+    norm_update_direction = (update_direction ** 2).sum().item()
+
+    res = stochastic.backtracking_step_size(x, f_t, None, f_grad, certificate,
+                                            1e-3, 1., update_direction,
+                                            norm_update_direction)
+    res_batched = stochastic.backtracking_step_size(x, f_t, None, f_grad,
+                                                    certificate, 1e-3, 1.,
+                                                    update_direction,
+                                                    norm_update_direction,
+                                                    batched=True)
+    for val, val_batched in zip(res, res_batched):
+        assert np.allclose(val, val_batched)
+
+    # large Lipschitz estimates exhaust the line search
+    # without overflowing in float32
+    def f_grad_increasing(x):
+        return 1e10 + x.sum(-1), torch.ones_like(x)
+
+    with pytest.warns(RuntimeWarning):
+        res = stochastic.backtracking_step_size(x, f_t, None, f_grad_increasing,
+                                                certificate, 1e10, 1.,
+                                                update_direction,
+                                                norm_update_direction)
+    with pytest.warns(RuntimeWarning):
+        res_batched = stochastic.backtracking_step_size(x, f_t, None,
+                                                        f_grad_increasing,
+                                                        certificate, 1e10, 1.,
+                                                        update_direction,
+                                                        norm_update_direction,
+                                                        batched=True)
+    assert np.isclose(res[0], res_batched[0], rtol=1e-6, atol=0)
+    assert np.isclose(res[1], res_batched[1])
+    assert 0 < res_batched[0] and np.isfinite(res_batched[1])
+
+
+@pytest.mark.parametrize('algorithm', [stochastic.PGD,
+                                       stochastic.PGDMadry,
+                                       stochastic.FrankWolfe,
+                                       stochastic.S3CM])
+def test_oracles_per_parameter(algorithm):
+    """Each parameter must keep its own oracle."""
+    constraints = [chop.constraints.L1Ball(alpha), chop.constraints.LinfBall(alpha / 10)]
+    params = [Variable(torch.zeros_like(w), requires_grad=True) for _ in constraints]
+
+    constraint_oracles = {
+        stochastic.PGD.name: {
+            'prox': [c.prox for c in constraints]
+        },
+        stochastic.PGDMadry.name: {
+            'prox': [c.prox for c in constraints],
+            'lmo': [c.lmo for c in constraints]
+        },
+        stochastic.FrankWolfe.name: {
+            'lmo': [c.lmo for c in constraints]
+        },
+        stochastic.S3CM.name: {
+            'prox1': [c.prox for c in constraints],
+            'prox2': [c.prox for c in constraints]
+        }
+    }
+    optimizer = algorithm(params, **(constraint_oracles[algorithm.name]))
+
+    x = 2 * w
+    for name in ('prox', 'prox1', 'prox2'):
+        for oracle, c in zip(getattr(optimizer, name, []), constraints):
+            assert torch.allclose(oracle(x), c.prox(x.unsqueeze(0)).squeeze(0))
+    for oracle, c in zip(getattr(optimizer, 'lmo', []), constraints):
+        update_direction, _ = oracle(-x, w)
+        assert torch.allclose(update_direction,
+                              c.lmo(-x.unsqueeze(0), w.unsqueeze(0))[0].squeeze(0))
+
+
+@pytest.mark.parametrize('algorithm', [stochastic.PGD,
+                                       stochastic.PGDMadry,
+                                       stochastic.FrankWolfe,
+                                       stochastic.S3CM])
+def test_oracles_per_parameter_without_gradient(algorithm):
+    """Parameters keep their own oracle when earlier ones have no gradient."""
+    radius = alpha / 100
+    constraints = [chop.constraints.L1Ball(100 * alpha), chop.constraints.LinfBall(radius)]
+    params = [Variable(torch.zeros_like(w), requires_grad=True) for _ in constraints]
+
+    constraint_oracles = {
+        stochastic.PGD.name: {
+            'prox': [constraints[0].prox, constraints[1].prox]
+        },
+        stochastic.PGDMadry.name: {
+            'prox': [None, constraints[1].prox],
+            'lmo': [c.lmo for c in constraints]
+        },
+        stochastic.FrankWolfe.name: {
+            'lmo': [c.lmo for c in constraints]
+        },
+        stochastic.S3CM.name: {
+            'prox1': [c.prox for c in constraints],
+            'prox2': [c.prox for c in constraints]
+        }
+    }
+    optimizer = algorithm(params, **(constraint_oracles[algorithm.name]))
+
+    for p in params:
+        p.grad = -torch.ones_like(p)
+    optimizer.step()
+    params[0].grad = None
+    for _ in range(5):
+        params[1].grad = -10 * torch.ones_like(params[1])
+        optimizer.step()
+    assert abs(params[1]).max() <= radius + 1e-6
+
+
+def test_pgd_prox_and_identity_without_gradient():
+    constraint = chop.constraints.LinfBall(alpha)
+    params = [Variable(torch.zeros_like(w), requires_grad=True) for _ in range(2)]
+    optimizer = stochastic.PGD(params, prox=[constraint.prox, None], momentum=0.)
+    for p in params:
+        p.grad = torch.ones_like(p)
+    optimizer.step()
+    params[0].grad = None
+    optimizer.step()
+    assert torch.allclose(params[1], -2 * optimizer.lr * torch.ones_like(w))
+
+
+@pytest.mark.parametrize('normalization', ['none', 'L2', 'Linf', 'sign'])
+@pytest.mark.parametrize('lr', [.1, 'sublinear'])
+def test_pgd_without_prox(normalization, lr):
+    """Parameters without prox, updated together with foreach ops,
+    follow the per-parameter PGD iterates and certificates."""
+    momentum = .9
+    generator = torch.Generator().manual_seed(0)
+    shapes = [(n_features,), (3, 4), (1, 5), (2, 1, 3)]
+    params = [torch.zeros(shape, requires_grad=True) for shape in shapes]
+    ref_params = [torch.zeros(shape) for shape in shapes]
+    ref_estimates = [None] * len(shapes)
+    ref_steps = [0] * len(shapes)
+    optimizer = stochastic.PGD(params, prox=[None] * len(shapes), lr=lr,
+                               momentum=momentum, normalization=normalization)
+
+    for it in range(6):
+        # the first parameter skips some steps, so that with a sublinear lr
+        # step sizes differ across parameters
+        with_grad = range(1, len(shapes)) if it % 3 == 1 else range(len(shapes))
+        params[0].grad = None
+        for idx in with_grad:
+            params[idx].grad = torch.randn(shapes[idx], generator=generator)
+        optimizer.step()
+
+        for idx in with_grad:
+            grad = params[idx].grad
+            ref_steps[idx] += 1
+            if ref_estimates[idx] is None:
+                ref_estimates[idx] = (1. - momentum) * grad
+            else:
+                ref_estimates[idx] = momentum * ref_estimates[idx] + (1. - momentum) * grad
+            step_size = 1. / (ref_steps[idx] + 1.) if lr == 'sublinear' else lr
+            direction = {
+                'none': lambda g: g,
+                'L2': lambda g: g / torch.linalg.norm(g),
+                'Linf': lambda g: g / abs(g).max(),
+                'sign': torch.sign
+            }[normalization](ref_estimates[idx])
+            ref_params[idx] = ref_params[idx] - step_size * direction
+            assert torch.allclose(optimizer.state[params[idx]]['certificate'],
+                                  torch.linalg.norm(direction))
+
+        for p, ref_p in zip(params, ref_params):
+            assert torch.allclose(p, ref_p, atol=1e-6)
+
+
+@pytest.mark.parametrize('algorithm, name', [(stochastic.PGD, 'prox'),
+                                             (stochastic.FrankWolfe, 'lmo')])
+def test_batched_oracles(algorithm, name):
+    """For a separable constraint, calling the oracle once on all
+    parameters gives the same iterates as calling it on each parameter."""
+    constraint = chop.constraints.LinfBall(alpha / 100)
+    criterion = torch.nn.MSELoss(reduction='mean')
+    iterates = []
+    for batched in (False, True):
+        params = [Variable(torch.zeros(n_features), requires_grad=True),
+                  Variable(torch.zeros(3, n_features), requires_grad=True)]
+        optimizer = algorithm(params, **{name: [getattr(constraint, name)] * 2,
+                                         f'batched_{name}': batched})
+        for _ in range(10):
+            optimizer.zero_grad()
+            loss = criterion(X.mv(params[0]) + X.mm(params[1].T).sum(1), y)
+            loss.backward()
+            optimizer.step()
+        iterates.append(params)
+
+    for p, p_batched in zip(*iterates):
+        assert torch.allclose(p, p_batched)
+
+
+@pytest.mark.parametrize('algorithm, name', [(stochastic.PGD, 'prox'),
+                                             (stochastic.FrankWolfe, 'lmo')])
+def test_batched_oracles_fixed_parameters(algorithm, name):
+    """The flat buffer holds parameters of one dtype and device,
+    given at initialization."""
+    constraint = chop.constraints.LinfBall(alpha)
+    oracles = {name: [getattr(constraint, name)] * 2, f'batched_{name}': True}
+    params = [torch.zeros(n_features, requires_grad=True),
+              torch.zeros(n_features, dtype=torch.float64, requires_grad=True)]
+    with pytest.raises(ValueError):
+        algorithm(params, **oracles)
+    params = [torch.zeros(n_features, requires_grad=True) for _ in range(2)]
+    optimizer = algorithm(params, **oracles)
+    with pytest.raises(ValueError):
+        optimizer.add_param_group({'params': [torch.zeros(3, requires_grad=True)]})
+
+
+@pytest.mark.parametrize('algorithm', [stochastic.PGD,
+                                       stochastic.FrankWolfe,
+                                       stochastic.S3CM])
+def test_compile(algorithm):
+    """Compiled steps give the same iterates as eager ones,
+    for parameters of any rank."""
+    constraint = chop.constraints.LinfBall(alpha / 100)
+    constraint_oracles = {
+        stochastic.PGD.name: {'prox': [constraint.prox] * 3},
+        stochastic.FrankWolfe.name: {'lmo': [constraint.lmo] * 3,
+                                     'normalization': 'gradient'},
+        stochastic.S3CM.name: {'prox1': [constraint.prox] * 3,
+                               'prox2': [constraint.prox] * 3,
+                               'normalization': 'L2'}
+    }
+    criterion = torch.nn.MSELoss(reduction='mean')
+    iterates = []
+    for compile_steps in (False, True):
+        params = [Variable(torch.zeros(n_features), requires_grad=True),
+                  Variable(torch.zeros(3, n_features), requires_grad=True),
+                  Variable(torch.zeros(1, 1, n_features), requires_grad=True)]
+        optimizer = algorithm(params, **constraint_oracles[algorithm.name],
+                              compile_steps=compile_steps)
+        for _ in range(10):
+            optimizer.zero_grad()
+            loss = criterion(X.mv(params[0]) + X.mm(params[1].T).sum(1)
+                             + X.mv(params[2].view(-1)), y)
+            loss.backward()
+            optimizer.step()
+        iterates.append(params)
+
+    for p, p_compiled in zip(*iterates):
+        assert torch.allclose(p, p_compiled, atol=1e-6)
+
+
+def test_compiled_updates_are_seen_by_autograd():
+    """In-place updates of compiled steps bump the parameter's version."""
+    p = torch.ones(3, 2, requires_grad=True)
+    loss = (p * p).sum()
+    with torch.no_grad():
+        stochastic._compiled_fw_normalized_update(p, torch.ones(3, 2),
+                                                  torch.ones(3, 2), .1)
+    with pytest.raises(RuntimeError, match="inplace"):
+        loss.backward()
+
+
+def test_compile_failure(monkeypatch):
+    """Functions run without compilation if the compiler backend fails,
+    other errors are raised as is."""
+    calls = []
+
+    def failing_compile(fn, **kwargs):
+        def compiled(x):
+            calls.append(x)
+            if x.dtype == torch.int64:
+                raise RuntimeError("user error")
+            raise torch._dynamo.exc.BackendCompilerFailed(
+                fn, RuntimeError("no C compiler"), None)
+        return compiled
+
+    monkeypatch.setattr(torch, 'compile', failing_compile)
+    double = stochastic._compile(lambda x: 2 * x)
+    with pytest.raises(RuntimeError, match="user error"):
+        double(torch.ones(3, dtype=torch.int64))
+    x = torch.ones(3, 2)
+    with pytest.warns(RuntimeWarning):
+        assert torch.equal(double(x), 2 * x)
+    assert torch.equal(double(x), 2 * x)
+    assert len(calls) == 2
+
+
+def test_capture_requires_constant_hyperparameters():
+    w_t = Variable(torch.zeros_like(w), requires_grad=True)
+    optimizer = stochastic.PGD([w_t], lr='sublinear')
+    with pytest.raises(ValueError):
+        optimizer.capture()
+    constraint = chop.constraints.LinfBall(alpha)
+    optimizer = stochastic.FrankWolfe([w_t], [constraint.lmo], momentum=None)
+    with pytest.raises(ValueError):
+        optimizer.capture()
+
+
+@pytest.mark.parametrize('algorithm', [stochastic.PGD, stochastic.FrankWolfe])
+def test_capture_requires_cuda(algorithm):
+    """Capturing a CPU step would record an empty graph."""
+    w_t = Variable(torch.zeros_like(w), requires_grad=True)
+    constraint = chop.constraints.LinfBall(alpha)
+    kwargs = {'lmo': [constraint.lmo]} if algorithm is stochastic.FrankWolfe else {}
+    optimizer = algorithm([w_t], **kwargs)
+    w_t.grad = torch.ones_like(w_t)
+    with pytest.raises(RuntimeError):
+        optimizer.capture()
+    assert torch.equal(w_t, torch.zeros_like(w))
+
+
+def test_captured_step_dropped():
+    """The captured step is dropped when it would use stale lr,
+    state or gradients."""
+    w_t = Variable(torch.zeros_like(w), requires_grad=True)
+    optimizer = stochastic.PGD([w_t])
+    optimizer._graph = object()
+    optimizer.lr = .5
+    assert optimizer._graph is None
+
+    w_t.grad = torch.ones_like(w_t)
+    optimizer.step()
+    state_dict = optimizer.state_dict()
+    optimizer._graph = object()
+    optimizer.load_state_dict(state_dict)
+    assert optimizer._graph is None
+
+    optimizer._graph, optimizer._graph_grads = object(), [None]
+    with pytest.warns(RuntimeWarning):
+        optimizer.step()
+    assert optimizer._graph is None
+
+    optimizer = stochastic.PGDMadry([w_t], [chop.constraints.LinfBall(alpha).lmo])
+    assert not hasattr(optimizer, '_graph')
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires CUDA")
+@pytest.mark.parametrize('algorithm', [stochastic.PGD, stochastic.FrankWolfe])
+def test_capture(algorithm):
+    """Replaying the captured step gives the same iterates as running it."""
+    constraint = chop.constraints.LinfBall(alpha / 100)
+    X_cuda, y_cuda = X.cuda(), y.cuda()
+    criterion = torch.nn.MSELoss(reduction='mean')
+    iterates = []
+    for capture in (False, True):
+        w_t = torch.zeros_like(w, device='cuda', requires_grad=True)
+        kwargs = {'lmo': [constraint.lmo]} if algorithm is stochastic.FrankWolfe else {}
+        optimizer = algorithm([w_t], **kwargs)
+        criterion(X_cuda.mv(w_t), y_cuda).backward()
+        if capture:
+            optimizer.capture()
+        else:
+            optimizer.step()
+        for _ in range(10):
+            optimizer.zero_grad(set_to_none=False)
+            criterion(X_cuda.mv(w_t), y_cuda).backward()
+            optimizer.step()
+        iterates.append(w_t)
+
+    assert torch.allclose(*iterates)
+
+
+@pytest.mark.parametrize('algorithm', [stochastic.PGDMadry, stochastic.FrankWolfe])
+def test_unbatched_oracles(algorithm):
+    """Oracles acting on a single parameter give the same iterates
+    as the batched ones from chop.constraints."""
+    radius = alpha / 100
+    constraint = chop.constraints.LinfBall(radius)
+
+    def lmo(u, x):
+        return radius * torch.sign(u) - x, 1.
+
+    def prox(x, s=None):
+        return torch.clamp(x, min=-radius, max=radius)
+
+    constraint_oracles = {
+        stochastic.PGDMadry.name: ({'lmo': [constraint.lmo], 'prox': [constraint.prox]},
+                                   {'lmo': [lmo], 'prox': [prox]}),
+        stochastic.FrankWolfe.name: ({'lmo': [constraint.lmo]},
+                                     {'lmo': [lmo]})
+    }
+    criterion = torch.nn.MSELoss(reduction='mean')
+    iterates = []
+    for unbatched, oracles in zip((False, True), constraint_oracles[algorithm.name]):
+        w_t = Variable(torch.zeros_like(w), requires_grad=True)
+        optimizer = algorithm([w_t], **oracles, unbatched=unbatched)
+        for _ in range(10):
+            optimizer.zero_grad()
+            loss = criterion(X.mv(w_t), y)
+            loss.backward()
+            optimizer.step()
+        iterates.append(w_t)
+
+    assert torch.allclose(*iterates)